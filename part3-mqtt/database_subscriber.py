@@ -4,122 +4,249 @@ QoS=2 Database Subscriber - Demonstrates exactly-once message reception
 This shows the four-step handshake for guaranteed exactly-once delivery
 """
 import paho.mqtt.client as mqtt
-import json
+import msgspec
+import functools
+import logging
+import logging.handlers
+import queue
+import signal
 import sqlite3
+import sys
+import threading
+import time
 import os
-from datetime import datetime
 
 # Configuration - Environment variables for Docker deployment
 BROKER = os.getenv("BROKER", "localhost")  # MQTT broker hostname
 PORT = int(os.getenv("PORT", "1883"))      # MQTT broker port
+BROKER_SOCKET = os.getenv("BROKER_SOCKET")  # Broker's Unix socket, used instead of TCP when set
+BROKER_ADDRESS = BROKER_SOCKET or f"{BROKER}:{PORT}"  # Where we connect, for log messages
+KEEPALIVE = 600                            # Seconds between PINGREQs when otherwise idle
 TOPIC = "sensor/data"                      # Topic to subscribe to
+SHARE_GROUP = os.getenv("SHARE_GROUP", "db")  # Shared subscription group
+CLIENT_ID = os.getenv("CLIENT_ID", "Database_Subscriber_QoS2")  # Unique per subscriber
 DB_FILE = os.getenv("DB_FILE", "sensor_data.db")  # SQLite database file
+BATCH_SIZE = 100                           # Most readings written in one statement
+FLUSH_INTERVAL = 1.0                       # Longest a reading waits for its batch to fill (seconds)
+QUEUE_SIZE = 10000                         # Readings waiting to be written before on_message blocks
+
+class SensorReading(msgspec.Struct, array_like=True):
+    """Sensor data packet published by the PLC, sent as a MessagePack array"""
+    timestamp: float
+    temperature: float
+    pressure: float
+    unit_id: str
+
+# Decoder built once; it parses and type-checks payloads in a single pass
+DECODER = msgspec.msgpack.Decoder(SensorReading)
+
+# Each batch is written with a single multi-row INSERT. BATCH_SIZE * 5
+# parameters stays well under SQLite's host parameter limit.
+INSERT_PREFIX = ("INSERT INTO sensor_readings "
+                 "(timestamp, temperature, pressure, unit_id, received_at) VALUES ")
+INSERT_ROW = "(?, ?, ?, ?, ?)"
+
+# Single database connection opened by setup_database(). on_message runs on
+# paho's network thread and only queues readings; one writer thread owns the
+# connection after setup and writes the queue out in batches, so acknowledging
+# messages never waits on SQLite.
+CONN = None
+WRITE_QUEUE = queue.Queue(maxsize=QUEUE_SIZE)
+
+# Log records are queued and written to stdout by a listener thread, so the
+# paho callback thread never blocks on console output
+log = logging.getLogger("database_subscriber")
+
+def setup_logging():
+    """Route log output through a queue to stdout, returns the started listener"""
+    log_queue = queue.Queue(-1)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(logging.INFO)
+    listener.start()
+    return listener
+
+def connect_database():
+    """Open the database with write-ahead logging enabled"""
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    
+    if DB_FILE != ":memory:":
+        # 8 KiB pages; only takes effect when the file is first created, and
+        # has to come before the switch to WAL, which fixes the page size
+        conn.execute("PRAGMA page_size=8192")
+        
+        # WAL appends each commit to a log instead of rewriting a rollback
+        # journal, and NORMAL only syncs that log at checkpoints.
+        # journal_mode is stored in the file, synchronous is per connection.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        
+        # Read pages through a memory map of up to 1 GiB instead of read(), so
+        # they are shared with the OS page cache rather than copied into ours
+        conn.execute("PRAGMA mmap_size=1073741824")
+    
+    # Keep temporary tables and sort space in memory rather than temp files
+    conn.execute("PRAGMA temp_store=MEMORY")
+    
+    # 64 MB page cache (negative values are in KiB)
+    conn.execute("PRAGMA cache_size=-64000")
+    
+    return conn
 
 def setup_database():
-    """Create database table if it doesn't exist"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    """Open the database and create the table if it doesn't exist"""
+    global CONN
+    CONN = connect_database()
     
     # Create table for sensor data
-    cursor.execute('''
+    CONN.execute('''
         CREATE TABLE IF NOT EXISTS sensor_readings (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             timestamp REAL,
             temperature REAL,
             pressure REAL,
             unit_id TEXT,
-            received_at TEXT
+            received_at REAL
         )
     ''')
     
-    conn.commit()
-    conn.close()
-    print(f"Database ready: {DB_FILE}")
+    # Index for looking up a unit's readings by time
+    CONN.execute('''
+        CREATE INDEX IF NOT EXISTS idx_unit_ts
+        ON sensor_readings (unit_id, timestamp)
+    ''')
+    
+    log.info("Database ready: %s", DB_FILE)
+
+# Cached so the statement text isn't rebuilt for every batch
+@functools.lru_cache(maxsize=None)
+def insert_sql(rows):
+    """INSERT statement that writes `rows` readings at once"""
+    return INSERT_PREFIX + ", ".join([INSERT_ROW] * rows)
 
-def on_connect(client, userdata, flags, rc):
+def write_batch(batch):
+    """Write a batch of readings to the database with one INSERT statement"""
+    # A single statement is atomic on its own, no explicit transaction needed
+    params = [value for row in batch for value in row]
+    try:
+        CONN.execute(insert_sql(len(batch)), params)
+    except sqlite3.Error as e:
+        log.error("Error writing %d readings to database: %s", len(batch), e)
+    else:
+        log.info("Stored %d readings in %s", len(batch), DB_FILE)
+
+def write_readings():
+    """Background thread - writes queued readings in batches until it gets None"""
+    while True:
+        # Wait for one reading, then keep collecting until the batch is full
+        # or FLUSH_INTERVAL has passed, so bursts share a single write
+        batch = [WRITE_QUEUE.get()]
+        deadline = time.monotonic() + FLUSH_INTERVAL
+        while batch[-1] is not None and len(batch) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(WRITE_QUEUE.get(timeout=remaining))
+            except queue.Empty:
+                break
+        
+        stopping = batch[-1] is None
+        if stopping:
+            batch.pop()
+        if batch:
+            write_batch(batch)
+        if stopping:
+            return
+
+def on_connect(client, userdata, flags, reason_code, properties):
     """Callback when MQTT client connects to broker"""
-    if rc == 0:
-        print(f"Connected to MQTT broker at {BROKER}:{PORT}")
-        # Subscribe to the sensor data topic with QoS=2
-        result = client.subscribe(TOPIC, qos=2)
-        print(f"Subscribed to topic: {TOPIC} with QoS=2 (exactly once delivery)")
+    if reason_code == 0:
+        log.info("Connected to MQTT broker at %s", BROKER_ADDRESS)
+        # Subscribe to the sensor data topic with QoS=2 as part of SHARE_GROUP -
+        # the broker spreads messages across every subscriber in the group
+        result = client.subscribe(f"$share/{SHARE_GROUP}/{TOPIC}", qos=2)
+        log.info("Subscribed to topic: %s with QoS=2 (exactly once delivery, shared group: %s)",
+                 TOPIC, SHARE_GROUP)
     else:
-        print(f"Failed to connect to broker. Error code: {rc}")
+        log.error("Failed to connect to broker. Error code: %s", reason_code)
 
-def on_subscribe(client, userdata, mid, granted_qos):
+def on_subscribe(client, userdata, mid, reason_code_list, properties):
     """Callback when subscription is successful"""
-    print(f"Subscription confirmed (MsgID: {mid}, Granted QoS: {granted_qos})")
-    print(f"   Ready to receive QoS=2 messages with four-step handshake")
+    # MQTT v5 SUBACK carries a reason code per topic, its value is the granted QoS
+    granted_qos = [code.value for code in reason_code_list]
+    log.info("Subscription confirmed (MsgID: %s, Granted QoS: %s)", mid, granted_qos)
+    log.info("   Ready to receive QoS=2 messages with four-step handshake")
 
 def on_message(client, userdata, msg):
     """Callback when a message is received from MQTT"""
+    # Decode and validate the MessagePack message straight from the payload bytes;
+    # a malformed or mistyped payload is the only expected failure
     try:
-        # Show message details with QoS=2 info
-        print(f"   Received QoS=2 message on topic: {msg.topic}")
-        print(f"   Message ID: {msg.mid}, QoS: {msg.qos}")
-        print(f"   Four-step handshake in progress: PUBLISH → PUBREC → PUBREL → PUBCOMP")
-        
-        # Decode the JSON message
-        payload = msg.payload.decode('utf-8')
-        print(f"   Raw payload: {payload}")
-        
-        data = json.loads(payload)
-        
-        # Extract sensor values
-        timestamp = data.get('timestamp', 0)
-        temperature = data.get('temperature', 0)
-        pressure = data.get('pressure', 0)
-        unit_id = data.get('unit_id', 'unknown')
-        received_at = datetime.now().isoformat()
-        
-        # Store in database
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO sensor_readings 
-            (timestamp, temperature, pressure, unit_id, received_at)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (timestamp, temperature, pressure, unit_id, received_at))
-        
-        conn.commit()
-        conn.close()
-        
-        # Print what we received and stored
-        print(f"Stored: Temp={temperature}°C, Pressure={pressure} bar from {unit_id}")
-        print(f"Received at: {received_at}")
-        print(f"QoS=2 handshake completing - message delivered exactly once")
-        print("─" * 70)
-        
-    except Exception as e:
-        print(f"Error processing message: {e}")
-        print(f"Raw payload was: {msg.payload}")
+        reading = DECODER.decode(msg.payload)
+    except msgspec.DecodeError as e:
+        log.error("Error processing message: %s (raw payload: %r)", e, msg.payload)
         # Note: QoS=2 ensures message is delivered exactly once even if processing fails
+        return
+    
+    # Hand the reading to the writer thread
+    received_at = time.time()  # Epoch seconds, same as the PLC's timestamp
+    WRITE_QUEUE.put((reading.timestamp, reading.temperature, reading.pressure,
+                     reading.unit_id, received_at))
+    
+    # One log line per message with what we received; write_batch() logs
+    # once the reading is actually in the database
+    log.info("Received: Temp=%s°C, Pressure=%s bar from %s (topic: %s, MsgID: %s, QoS: %s) "
+             "- four-step handshake delivers it exactly once",
+             reading.temperature, reading.pressure, reading.unit_id, msg.topic, msg.mid, msg.qos)
 
 def main():
     """Main function - sets up database and MQTT subscriber"""
-    # Initialize database
+    # Initialize logging, database and the background database writer
+    listener = setup_logging()
     setup_database()
+    writer = threading.Thread(target=write_readings, daemon=True)
+    writer.start()
     
-    # Create MQTT client with unique ID
-    client_id = "Database_Subscriber_QoS2"
-    client = mqtt.Client(client_id=client_id)
+    # Create MQTT v5 client with unique ID, using paho's version 2 callback signatures
+    client_id = CLIENT_ID
+    transport = "unix" if BROKER_SOCKET else "tcp"
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id,
+                         protocol=mqtt.MQTTv5, transport=transport)
     client.on_connect = on_connect
     client.on_subscribe = on_subscribe
     client.on_message = on_message
     
+    # Raise paho's flow-control limits so QoS>0 traffic isn't held back
+    client.max_inflight_messages_set(100)
+    client.max_queued_messages_set(10000)
+    
+    # docker-compose stop/down sends SIGTERM; turn it into SystemExit so it
+    # drains the write queue the same way Ctrl-C does
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    
     try:
         # Connect to broker
-        print(f"Connecting to MQTT broker at {BROKER}:{PORT} with Client ID: {client_id}")
-        client.connect(BROKER, PORT, 60)
+        log.info("Connecting to MQTT broker at %s with Client ID: %s", BROKER_ADDRESS, client_id)
+        client.connect(BROKER_SOCKET or BROKER, PORT, KEEPALIVE)
         
-        # Start listening for messages (blocking call)
-        print("Listening for sensor data...")
-        client.loop_forever()
+        # Handle network traffic and callbacks in paho's background thread,
+        # the main thread just waits until we're interrupted
+        log.info("Listening for sensor data...")
+        client.loop_start()
+        threading.Event().wait()
         
-    except KeyboardInterrupt:
-        print("\nShutting down database subscriber...")
+    except (KeyboardInterrupt, SystemExit):
+        log.info("\nShutting down database subscriber...")
         client.disconnect()
+        client.loop_stop()
+        WRITE_QUEUE.put(None)  # Writer finishes what's queued, then exits
+        writer.join()
+        CONN.close()
+        listener.stop()
 
 if __name__ == "__main__":
     main()
@@ -4,7 +4,7 @@ QoS=2 PLC Publisher - Demonstrates exactly-once message delivery
 This shows the four-step handshake: PUBLISH → PUBREC → PUBREL → PUBCOMP
 """
 import paho.mqtt.client as mqtt
-import json
+import msgspec
 import time
 import random
 import os
@@ -12,78 +12,102 @@ import os
 # Configuration - Environment variables for Docker deployment
 BROKER = os.getenv("BROKER", "localhost")  # MQTT broker hostname
 PORT = int(os.getenv("PORT", "1883"))      # MQTT broker port
+BROKER_SOCKET = os.getenv("BROKER_SOCKET")  # Broker's Unix socket, used instead of TCP when set
+BROKER_ADDRESS = BROKER_SOCKET or f"{BROKER}:{PORT}"  # Where we connect, for log messages
+KEEPALIVE = 600                            # Seconds between PINGREQs when otherwise idle
 TOPIC = "sensor/data"                      # Topic to publish data to
 PUBLISH_INTERVAL = 3                       # Publish every 3 seconds
 
-def on_connect(client, userdata, flags, rc):
+# Bound once so generating a reading skips the module attribute and
+# builtin lookups
+_random = random.random
+_time = time.time
+_round = round
+
+class SensorReading(msgspec.Struct, array_like=True):
+    """Sensor data packet published to TOPIC, sent as a MessagePack array"""
+    timestamp: float
+    temperature: float
+    pressure: float
+    unit_id: str
+
+# MessagePack encoder built once and reused for every reading
+ENCODER = msgspec.msgpack.Encoder()
+
+def on_connect(client, userdata, flags, reason_code, properties):
     """Callback when MQTT client connects to broker"""
-    if rc == 0:
-        print(f"Connected to MQTT broker at {BROKER}:{PORT}")
+    if reason_code == 0:
+        print(f"Connected to MQTT broker at {BROKER_ADDRESS}")
         print(f"Will publish to topic: {TOPIC} with QoS=2 (exactly once)")
     else:
-        print(f"Failed to connect to broker. Error code: {rc}")
+        print(f"Failed to connect to broker. Error code: {reason_code}")
 
-def on_publish(client, userdata, mid):
+def on_publish(client, userdata, mid, reason_code, properties):
     """Callback when PUBCOMP is received from broker (QoS=2 handshake complete)"""
     print(f"PUBCOMP received! Message {mid} exactly-once delivery confirmed")
     print(f"   Four-step handshake complete: PUBLISH → PUBREC → PUBREL → PUBCOMP")
     print(f"   Message guaranteed delivered exactly once")
 
-def on_unsubscribe(client, userdata, mid):
+def on_unsubscribe(client, userdata, mid, reason_code_list, properties):
     """Callback for unsubscribe (not used but helpful for debugging)"""
     pass
 
 def generate_sensor_data():
     """Generate simulated sensor readings"""
     # Simulate temperature sensor (20-30°C with some variation)
-    temperature = 25 + random.uniform(-5, 5)
+    temperature = 25 + (_random() - 0.5) * 10
     
     # Simulate pressure sensor (1.0-2.0 bar with some variation)  
-    pressure = 1.5 + random.uniform(-0.5, 0.5)
+    pressure = 1.5 + (_random() - 0.5)
     
     # Create data packet with timestamp
-    data = {
-        "timestamp": time.time(),
-        "temperature": round(temperature, 2),
-        "pressure": round(pressure, 2),
-        "unit_id": "PLC-001"
-    }
-    
-    return data
+    return SensorReading(
+        timestamp=_time(),
+        temperature=_round(temperature, 2),
+        pressure=_round(pressure, 2),
+        unit_id="PLC-001"
+    )
 
 def main():
     """Main function - sets up MQTT client and publishes data"""
-    # Create MQTT client with unique ID
+    # Create MQTT v5 client with unique ID, using paho's version 2 callback signatures
     client_id = "PLC_Publisher_QoS2"
-    client = mqtt.Client(client_id=client_id)
+    transport = "unix" if BROKER_SOCKET else "tcp"
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id,
+                         protocol=mqtt.MQTTv5, transport=transport)
     client.on_connect = on_connect
     client.on_publish = on_publish
     
     try:
         # Connect to broker
-        print(f"Connecting to MQTT broker at {BROKER}:{PORT} with Client ID: {client_id}")
-        client.connect(BROKER, PORT, 60)
+        print(f"Connecting to MQTT broker at {BROKER_ADDRESS} with Client ID: {client_id}")
+        client.connect(BROKER_SOCKET or BROKER, PORT, KEEPALIVE)
         client.loop_start()  # Start background network loop
         
-        # Main publishing loop
+        # Main publishing loop - schedule against a monotonic deadline so the
+        # time spent generating/publishing doesn't push each reading later
+        next_publish = time.monotonic()
         while True:
             # Generate new sensor data
             sensor_data = generate_sensor_data()
             
-            # Convert to JSON string
-            payload = json.dumps(sensor_data)
+            # Serialize to MessagePack bytes, which paho publishes as-is
+            payload = ENCODER.encode(sensor_data)
             
             # Publish to MQTT topic with QoS=2 (exactly once delivery)
             result = client.publish(TOPIC, payload, qos=2)
             
             # Print what we sent with message ID
-            print(f"PUBLISH sent: Temp={sensor_data['temperature']}°C, "
-                  f"Pressure={sensor_data['pressure']} bar (MsgID: {result.mid}, QoS=2)")
-            print(f"   Payload: {payload}")
+            print(f"PUBLISH sent: Temp={sensor_data.temperature}°C, "
+                  f"Pressure={sensor_data.pressure} bar (MsgID: {result.mid}, QoS=2)")
+            print(f"   Payload: {len(payload)} bytes (MessagePack)")
             print(f"   Starting four-step handshake: PUBLISH → PUBREC → PUBREL → PUBCOMP")
             
-            # Wait before next reading
-            time.sleep(PUBLISH_INTERVAL)
+            # Wait until the next reading is due
+            next_publish += PUBLISH_INTERVAL
+            delay = next_publish - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
             
     except KeyboardInterrupt:
         print("\nShutting down PLC publisher...")